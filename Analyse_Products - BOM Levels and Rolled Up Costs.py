@@ -18,9 +18,16 @@
 #
 #  NOTE: the BOM Unit Cost field that may be present defines the unit cost of a Component No. is not used.
 #
+# The dictionary of Items is then flattened into a ProductTree - flat NumPy arrays indexed by product 
+# position, with the component lists held in compressed sparse row (CSR) form - which the depth and
+# rolled up cost calculations work on.  For large catalogues these calculations are JIT compiled to 
+# native code if Numba is installed, otherwise they run as plain Python.
+#
+# validateProductTree - Warnings logged: where a product refers to a component product that is not 
+# defined as a product in the source data, this is logged in a the log attribute of the associated Item
+# element .  The depth and cost calculations skip such components without logging them again.
+#
 # calculateProductTreeDepths - output the depth of the product tree for each product.  
-# Warnings logged: where a product refers to a component product that is not defined as a product
-# in the source data, this is logged in a the log attribute of the associated Item element .
 #
 # calculateProductRolledUpCosts - crawl the tree of components for each product in the Dictionary
 # and calculate the qtyPerTop (multiple of the component product )
@@ -28,16 +35,37 @@
 # REVISION HISTORY
 #
 
-import pandas as pd     
+import sys
 
-# Globals used in the recusive function calculateProductTreeDepth to track the product level
-currentLevel = 0
-maxLevel = 0
+import numpy as np
+import pandas as pd     
 
-# Flags to raise an error if recursive functions are called without first calling the 
-# associated initialising function
-calculateProductRolledUpCostSentinel = False
-calculateProductTreeDepthSentinel = False
+# Numba is optional and only used for catalogues of at least jitMinimumProductCount products.  Loading
+# Numba costs about 0.3s (1.3s on the first run while it compiles and caches the calculations), which
+# is more than the plain Python calculations take below about 100,000 products (about 0.7s).
+jitMinimumProductCount = 100000
+jitCompiledFunctions = {}
+
+def jitCompiled(function, productCount):
+  # Return the Numba compiled version of function for a large enough catalogue if Numba is installed, 
+  # otherwise function itself
+  if productCount < jitMinimumProductCount:
+    return function
+  if function not in jitCompiledFunctions:
+    try:
+      from numba import njit
+      jitCompiledFunctions[function] = njit(cache=True)(function)
+    except ImportError:
+      jitCompiledFunctions[function] = function
+  return jitCompiledFunctions[function]
+
+# PyArrow is optional - if it is installed pandas uses it to parse the CSV file, which is faster
+# than the default C parser
+try:
+  import pyarrow
+  csvEngine = 'pyarrow'
+except ImportError:
+  csvEngine = 'c'
 
 # Dictionary to hold catalogue of product data
 # A dictionary key in python is any immutable data type eg int, float, string
@@ -46,18 +74,26 @@ calculateProductTreeDepthSentinel = False
 # Item - an object of class Item which contains information about the Product
 itemsDictionary = {}      #instantiate the global dictionary
 
+# ProductTree built from itemsDictionary by createData - see class ProductTree
+productTree = None
+
 ##############################################################################################
 #  Data Definitions
 #
 class Item:
   # a class to represent an Item, including a list of component items
-  def __init__(self, item_number, itemReplenishmentSystem, BOMUnitCost):
+  # __slots__ - there is one Item per product so avoid a per-instance __dict__ 
+  __slots__ = ('item_number', 'level', 'itemList', 'log', 'replenishmentSystem', 'isPurchase', 'BOMUnitCost', 'qtyPerTopItem', 'componentIds')
+
+  def __init__(self, item_number, itemReplenishmentSystem, isPurchase, BOMUnitCost):
     self.item_number = item_number  # Item id
     self.level = -1                 #
     self.itemList = []              # List of ComponentItem objects
+    self.componentIds = set()       # Set of the component product ids in itemList - for fast duplicate checks
     self.log = []                   # List of log entries created as item is processed
     self.replenishmentSystem = itemReplenishmentSystem  # String read from data
-    self.BOMUnitCost = BOMUnitCost
+    self.isPurchase = isPurchase    # True if replenishmentSystem is "Purchase"
+    self.BOMUnitCost = BOMUnitCost  # float - NaN if blank in the data
     # qtyPerTopITem - should be set to 1.0 for the top level product when creating rolled up cost
     # for that product
     self.qtyPerTopItem = 1.0    #Initialise this to 1.0 
@@ -72,28 +108,78 @@ class ComponentItem:
   # as this qty is different for different parent products  
   # If the input data is complete, a ComponentItem will have an Item object in the dictionary 
   # of products.  
+  # The component id is always stored as a string to match the keys of the dictionary of products,
+  # so it can be used for lookups directly while crawling the product tree.
+  # __slots__ - there is one ComponentItem per row of the source data so avoid a per-instance __dict__ 
+  __slots__ = ('itemNumber', 'qtyPer')
+
   def __init__(self, itemNumber, qtyPer):
-    self.itemNumber = itemNumber
+    self.itemNumber = str(itemNumber)
     self.qtyPer = qtyPer
 
 
-##################################################################################################
-def remove_last_decimal_place(text):
-    if text[-1] == '.':
-        return text[:-1]
-    else:
-        return text
+class ProductTree:
+  # Class ProductTree - the dictionary of Items flattened into arrays so the tree calculations are 
+  # loops over contiguous int/float arrays rather than a crawl through Item and ComponentItem objects.
+  #
+  # Products are numbered 0..n-1 in dictionary order.  The components of product i are the entries
+  # indptr[i] to indptr[i+1]-1 of indices (the component's product number, or -1 if the component
+  # is not defined in the source data) and qtyPer.
+  #
+  # If the source data has a cycle of products (a product that is, through its components, a component
+  # of itself) the component reference that closes the cycle is flagged in cycleEdges and the products
+  # around the cycle are flagged in inCycle.
+  __slots__ = ('itemNumbers', 'itemIndex', 'indptr', 'indices', 'qtyPer', 'unitCost', 'order',
+               'cycleEdges', 'inCycle')
+
+  def __init__(self, itemsDictionary):
+    items = list(itemsDictionary.values())
+    edgeCount = sum(len(item.itemList) for item in items)
+
+    self.itemNumbers = list(itemsDictionary)     # Product id for each product number
+    self.itemIndex = {itemNumber: i for i, itemNumber in enumerate(self.itemNumbers)}   # Product id -> number
+
+    self.indptr = np.cumsum([0] + [len(item.itemList) for item in items], dtype=np.int64)
+    self.indices = np.fromiter((self.itemIndex.get(component.itemNumber, -1) for item in items for component in item.itemList),
+                               dtype=np.int64, count=edgeCount)
+    self.qtyPer = np.fromiter((component.qtyPer for item in items for component in item.itemList),
+                              dtype=np.float64, count=edgeCount)
+
+    # Only items of replenishment type Purchase contribute their own unit cost to a rolled up cost, so
+    # unitCost is 0.0 for every other item
+    self.unitCost = np.fromiter((item.BOMUnitCost if item.isPurchase else 0.0 for item in items),
+                                dtype=np.float64, count=len(items))
+
+    # Every product comes before its component products (ignoring any component reference that closes a cycle)
+    self.order, self.cycleEdges, self.inCycle = jitCompiled(calculateTopologicalOrder, len(items))(self.indptr, self.indices)
+
 
 ################################################################################################
 def printItemAndComponents():
   # Print the item and list of component items
-  for x in itemsDictionary:
+  for x, itemReference in itemsDictionary.items():
     print (x)
-    for y in itemsDictionary[x].itemList:
+    for y in itemReference.itemList:
       print (f"   Component: {y.itemNumber}   Qty Per: {y.qtyPer}")
 
 
 
+##################################################################################################
+# cleanProductIds
+# Function to clean a column of product ids read as strings.  Surrounding spaces, a trailing ".0" 
+# (eg "1003.0") and leading zeros are stripped, so the id is the string of the product number.
+# The ids are kept as strings throughout - converting them to float would lose digits from long ids.
+#
+# Returns (cleaned ids, NumPy array flagging the ids that are a whole number)
+##################################################################################################
+def cleanProductIds(productIds):
+
+  productIds = productIds.str.strip().str.replace(r'\.0*$', '', regex=True).str.replace(r'^0+(?=\d)', '', regex=True)
+  validProductIds = productIds.str.fullmatch(r'\d+').to_numpy(dtype=bool, na_value=False)
+
+  return productIds, validProductIds
+
+
 ##################################################################################################
 # Function to iterate over the rows in a Panda Data Frame in  which each row maps a Product to a 
 # component Product - a one to many relationship, so can be more than one row for a product.
@@ -101,64 +187,71 @@ def printItemAndComponents():
 ##################################################################################################
 def createData():
 
-  # Read data from file
-  df = pd.read_csv('rll-items-bom-with-cost.csv')
+  # Read data from file - only the columns that are used, with their types given up front rather than
+  # inferred.  Quantity per and Current Unit Cost (LCY) can contain thousands separators so are read as
+  # strings and cleaned below.
+  df = pd.read_csv('rll-items-bom-with-cost.csv', engine=csvEngine,
+                   usecols=['Item No.', 'No.', 'Quantity per', 'Item Replenishment System', 'Current Unit Cost (LCY)'],
+                   dtype={'Item No.': 'string',
+                          'No.': 'string',
+                          'Quantity per': 'string',
+                          'Item Replenishment System': 'category',
+                          'Current Unit Cost (LCY)': 'string'})
 
   # Clean up data - RLT
-  df['Quantity per'] = df.apply(lambda x: x['Quantity per'].replace(',', ''), axis=1)
-  df['Quantity per'] = df.apply(lambda x: remove_last_decimal_place(x['Quantity per']), axis=1)
-  df["Quantity per"] = pd.to_numeric(df["Quantity per"])
-  df['Quantity per'].head()
-
-  for index, row in df.iterrows():
-    # print(row['Item No.'], row['No.'])
+  # Strip thousands separators and any trailing decimal point (eg "1,000." -> "1000") using the
+  # vectorised pandas string methods rather than calling a Python function for every row
+  qtyPer = df['Quantity per'].str.replace(',', '', regex=False)
+  qtyPer = qtyPer.mask(qtyPer.str.endswith('.'), qtyPer.str.slice(0, -1))
+  df['Quantity per'] = pd.to_numeric(qtyPer, errors='coerce')
+
+  # Strip thousands separators from the unit cost (eg "3,040.66" -> 3040.66) - a blank cost is NaN
+  unitCost = df['Current Unit Cost (LCY)'].str.replace(',', '', regex=False)
+  df['Current Unit Cost (LCY)'] = pd.to_numeric(unitCost, errors='coerce')
+
+  # Product ids are stored as the string of the product number (eg "1003"), worked out for the whole column
+  # at once.  An Item No. that is missing or not a number is stored as "NAN" and logged, a No. that is
+  # missing means the row has no component product and one that is not a number is logged.
+  itemNumberValues, validItemNumbers = cleanProductIds(df['Item No.'])
+  itemComponentValues, validItemComponents = cleanProductIds(df['No.'])
+  invalidItemNumbers = ~validItemNumbers
+  invalidItemComponents = ~validItemComponents & df['No.'].notna().to_numpy()
+
+  # Pull each column out as a NumPy array and walk them together - iterrows() builds a pandas
+  # Series for every row which dominates the run time on a large BOM
+  itemNumbers = itemNumberValues.where(validItemNumbers, "NAN").to_numpy(dtype=object)
+  itemComponents = itemComponentValues.where(validItemComponents).to_numpy(dtype=object, na_value=None)
+  # Quantities are handed over as Python floats so the rolled up cost arithmetic (and rounding) is unchanged
+  itemComponentQtyPers = df['Quantity per'].to_numpy(dtype='float64', na_value=float('nan')).tolist()
+  itemReplenishmentSystems = df['Item Replenishment System'].to_numpy()
+  # Replenishment System is a category, so this compares category codes rather than strings row by row
+  itemIsPurchases = (df['Item Replenishment System'] == "Purchase").to_numpy()
+  # Unit costs are handed over as Python floats so the rolled up cost arithmetic (and rounding) is unchanged
+  itemBOMUnitCosts = df['Current Unit Cost (LCY)'].to_numpy(dtype=np.float64, na_value=np.nan).tolist()
+
+  for index, (itemNumber, itemComponent, itemComponentQtyPer, itemReplenishmentSystem, itemIsPurchase, itemBOMUnitCost, invalidItemValueDetected, invalidComponentValueDetected) in \
+      enumerate(zip(itemNumbers, itemComponents, itemComponentQtyPers, itemReplenishmentSystems, itemIsPurchases, itemBOMUnitCosts, invalidItemNumbers, invalidItemComponents)):
+    # print(itemNumber, itemComponent)
     
-    itemNumber = row['Item No.']
-    itemComponent = row['No.']
-    itemComponentQtyPer = row['Quantity per'] 
-    itemReplenishmentSystem = row['Item Replenishment System']
-    itemBOMUnitCost = row['Current Unit Cost (LCY)']
-    
-    invalidItemValueDetected = False
-
-    if pd.isna(itemNumber) == False: 
-      # Try to convert - some of the itemNumbers are not numbers  
-      try:
-        # itemNumber = str(itemNumber)   
-        itemNumber = int(itemNumber)
-      except ValueError:
-        invalidItemValueDetected = True
-        itemNumber - "NAN"
-    else:
-      itemNumber = "NAN"
-      invalidItemValueDetected = True
-
-    # Store the itemNumber as a string to use as the index in the dictionary
-    # As we have chosen for the Key in the dictionary to be a string so any lookup must use type string.
-    itemNumber=str(itemNumber)
-      
-    if pd.isna(itemComponent) == False:
-      itemComponent = int(itemComponent)   # Force the component number to integer rather than float
-      itemComponent = str(itemComponent)   # Force the integer version of product id to a string to store in list
-      
     if itemNumber in itemsDictionary:
       # Item already in dictionary - there can be more than one row for a item, 1 for each component item
       pass #Do nothing
     else:
       # Create Item object for this product and add to the dictionary
-      itemObject = Item(itemNumber, itemReplenishmentSystem, itemBOMUnitCost)     
+      itemObject = Item(itemNumber, itemReplenishmentSystem, bool(itemIsPurchase), itemBOMUnitCost)     
       itemsDictionary.update({itemNumber: itemObject})
 
     # Get a reference to the Item object for the product
     itemReference = itemsDictionary[itemNumber]
     
-    if pd.isna(itemComponent) == False:
-      if itemComponent in itemReference.itemList:    
+    if itemComponent is not None:
+      if itemComponent in itemReference.componentIds:    
         #Python f string used as shorthand to change variables to strings for output.
         itemReference.log.append(f"Product {itemNumber} refers to component product {itemComponent} more than once.")
       
       component = ComponentItem(itemComponent, itemComponentQtyPer)
       itemReference.itemList.append(component)
+      itemReference.componentIds.add(itemComponent)
 
       component = itemReference.itemList[-1]  # Get reference to the item added to the list...
       # print (f"Adding component for {itemNumber} Component - {component.itemNumber}, QtyPer - {component.qtyPer}")
@@ -168,7 +261,14 @@ def createData():
       pass
 
     if invalidItemValueDetected == True:
-      itemReference.log.append(f"Non-numeric Item No. detected in raw data, value read was: {itemNumber} on row {index}")
+      itemReference.log.append(f"Non-numeric Item No. detected in raw data, value read was: {df['Item No.'].iat[index]} on row {index}")
+
+    if invalidComponentValueDetected == True:
+      itemReference.log.append(f"Non-numeric No. detected in raw data for product {itemNumber}, value read was: {df['No.'].iat[index]} on row {index}")
+
+  # Flatten the catalogue into arrays for the tree calculations
+  global productTree
+  productTree = ProductTree(itemsDictionary)
 
 
 ############################################################################################################
@@ -177,16 +277,16 @@ def reportProductWarnings():
   print("================================== ")
   print("=== Warnings About Source Data === ")
   print("================================== ")
-  for x in itemsDictionary:
-    for logItem in itemsDictionary[x].log:
+  for itemReference in itemsDictionary.values():
+    for logItem in itemReference.log:
       print ("     ",logItem)
 
 ############################################################################################################
 # resetProductWarnings
 def resetProductWarnings():
   # Empty the log for each item in the Product dictionary
-  for x in itemsDictionary:
-    itemsDictionary[x].clearLog()
+  for itemReference in itemsDictionary.values():
+    itemReference.clearLog()
 
 ############################################################################################################
 # validateProductTree
@@ -194,11 +294,9 @@ def resetProductWarnings():
 def validateProductTree():
 
   # Iterate over all the products in the catalogue to discover and record max product depth for each
-  for x in itemsDictionary:  
-    itemReference = itemsDictionary[str(x)]
-
+  for itemReference in itemsDictionary.values():  
     for itemComponent in itemReference.itemList:
-      if str(itemComponent.itemNumber) in itemsDictionary:
+      if itemComponent.itemNumber in itemsDictionary:
         # The item is in the dictionary - nothing to report
         pass
       
@@ -207,77 +305,140 @@ def validateProductTree():
         # was not defined in the input data
         itemReference.log.append(f"Product {itemReference.item_number} refers to product {itemComponent.itemNumber} for which there is no definition in the source data.")
 
+  # Look for component products that lead back round to the product that refers to them
+  parents = np.repeat(np.arange(len(productTree.itemNumbers)), np.diff(productTree.indptr))
+  for k in np.flatnonzero(productTree.cycleEdges):
+    itemReference = itemsDictionary[productTree.itemNumbers[parents[k]]]
+    itemComponentNumber = productTree.itemNumbers[productTree.indices[k]]
+    itemReference.log.append(f"Product {itemReference.item_number} refers to product {itemComponentNumber} which is itself made from product {itemReference.item_number} - the product tree has a cycle.")
+
+  # Products in a cycle have no rolled up cost, and neither does any product made from one.  Working back
+  # through the topological order, the components of a product have always been checked first.
+  indptr, indices = productTree.indptr.tolist(), productTree.indices.tolist()
+  inCycle = productTree.inCycle.tolist()
+  madeFromCycle = [False] * len(inCycle)
+  for u in reversed(productTree.order.tolist()):
+    itemReference = itemsDictionary[productTree.itemNumbers[u]]
+    if inCycle[u]:
+      itemReference.log.append(f"Product {itemReference.item_number} is part of a cycle in the product tree - its rolled up cost cannot be calculated.")
+      continue
+
+    for c in indices[indptr[u]:indptr[u+1]]:
+      if c >= 0 and (inCycle[c] or madeFromCycle[c]):
+        madeFromCycle[u] = True
+        itemReference.log.append(f"Product {itemReference.item_number} is made from product {productTree.itemNumbers[c]} which has no rolled up cost because of a cycle in the product tree - its rolled up cost cannot be calculated.")
+        break
+
 
 ############################################################################################################
-# calculateProductTreeDepths
-def calculateProductTreeDepths():
+# calculateTopologicalOrder
+# Function to order the products in a CSR product tree (see class ProductTree) so that every product comes
+# before all of its component products.  Working through the order backwards, the components of a product
+# have always been dealt with before the product itself.
+#
+# The order is built by a depth first crawl with an explicit stack, keeping track of which products are on 
+# the stack.  A component that is already on the stack closes a cycle - that component reference is flagged
+# in cycleEdges and not crawled, and the products on the stack around the cycle are flagged in inCycle.
+#
+# Returns (order, cycleEdges, inCycle)
+def calculateTopologicalOrder(indptr, indices):
+
+  productCount = indptr.size - 1
+
+  order = np.empty(productCount, dtype=np.int64)
+  orderLength = productCount
+  cycleEdges = np.zeros(indices.size, dtype=np.bool_)
+  inCycle = np.zeros(productCount, dtype=np.bool_)
+
+  # Position of each product on the stack, -1 if not on the stack, -2 once it is in the order
+  stackPosition = np.full(productCount, -1, dtype=np.int64)
+  stackProducts = np.empty(productCount, dtype=np.int64)
+  stackNextEdges = np.empty(productCount, dtype=np.int64)
+
+  for root in range(productCount):
+    if stackPosition[root] != -1:
+      continue
+
+    stackProducts[0] = root
+    stackNextEdges[0] = indptr[root]
+    stackPosition[root] = 0
+    stackLength = 1
+
+    while stackLength > 0:
+      u = stackProducts[stackLength - 1]
+      k = stackNextEdges[stackLength - 1]
+
+      if k < indptr[u+1]:
+        stackNextEdges[stackLength - 1] = k + 1
+        component = indices[k]
+
+        if component < 0 or stackPosition[component] == -2:
+          # Not defined in the source data, or already in the order
+          continue
+
+        if stackPosition[component] >= 0:
+          # Component is already on the stack - the products from it to the top of the stack form a cycle
+          cycleEdges[k] = True
+          for p in range(stackPosition[component], stackLength):
+            inCycle[stackProducts[p]] = True
+          continue
+
+        stackProducts[stackLength] = component
+        stackNextEdges[stackLength] = indptr[component]
+        stackPosition[component] = stackLength
+        stackLength += 1
 
-  # Make explicit we are referring to global variables not function locals
-  global itemsDictionary
-  global currentLevel 
-  global maxLevel
-  global calculateProductTreeDepthSentinel
+      else:
+        # All components of u are in the order, so u goes in front of them
+        stackLength -= 1
+        stackPosition[u] = -2
+        orderLength -= 1
+        order[orderLength] = u
 
-  calculateProductTreeDepthSentinel = True  # Flag used to check that this function is called
-                                            # to start the crawl, rather than the recusive function
- 
-  # Iterate over all the products in the catalogue to discover and record max product depth for each
-  for x in itemsDictionary:  
-    currentLevel = 0   # Reset global
-    maxLevel = 0 # Reset global
-    calculateProductTreeDepth(str(x))
+  return order, cycleEdges, inCycle
 
-    # Record the product tree depth for the item
-    itemsDictionary[x].level = maxLevel
 
-  calculateProductTreeDepthSentinel = False
+############################################################################################################
+# calculateProductTreeDepths
+def calculateProductTreeDepths():
+
+  levels = jitCompiled(calculateProductTreeLevels, len(productTree.itemNumbers))(productTree.indptr, productTree.indices, productTree.order, productTree.cycleEdges)
+
+  # Record the product tree depth for each item
+  for itemReference, level in zip(itemsDictionary.values(), levels.tolist()):
+    itemReference.level = level
   
 
 
 ############################################################################################################
-# calculateProductTreeDepth
-# Function to crawl through the component products referenced by product with id itemName.
-# RECURSIVE Function that is should be called initially by calculateProductTreeDepths
-# which encapsulates the prerequisites of invoking this function.
-# 
-# Uses the globals currentLevel and maxLevel to track the depth of the product tree - before
-# the first call to calculateProductTreeDepth these should be set to 0 to allow the recursion to leave maxLevel on return to 
-# contain the depth of the tree.
-def calculateProductTreeDepth(itemName):
-
-   # Make explicit we are referring to global variables not function locals
-  global itemsDictionary
-  global currentLevel 
-  global maxLevel
-  global calculateProductTreeDepthSentinel
-
-  if calculateProductTreeDepthSentinel == False:
-    raise Exception("calculateProductTreeDepth called without calling initialising function calculateProductTreeDepths")
-  else:
-   
-   itemReference = itemsDictionary[itemName]
+# calculateProductTreeLevels
+# Function to calculate the depth of the tree below every product in a CSR product tree (0 for a product 
+# with no components) in a single pass, working back through the topological order so that
+#
+#     depth of product = max over components of (1 + depth of component)
+#
+# only ever uses the depth of component products that are already known.  A component that is not
+# defined in the source data counts as depth 0, and a component reference that closes a cycle is ignored.
+def calculateProductTreeLevels(indptr, indices, order, cycleEdges):
 
-   for x in itemsDictionary[itemName].itemList:
+  levels = np.zeros(indptr.size - 1, dtype=np.int64)
 
-      # Increment the currentLevel in the tree of product items
-      currentLevel = currentLevel + 1
+  for i in range(order.size - 1, -1, -1):
+    u = order[i]
+    maxLevel = 0
 
-      # Check if the component item is in the itemsDictionary - force the list item to string.
-      if str(x.itemNumber) in itemsDictionary:
-         calculateProductTreeDepth(str(x.itemNumber))
+    for k in range(indptr[u], indptr[u+1]):
+      component = indices[k]
+      componentLevel = 1
+      if component >= 0 and not cycleEdges[k]:
+        componentLevel = 1 + levels[component]
 
-      else:
-         # Could not find item in the Dictionary - a product referenced by a product
-         # was not defined in the input data
-         itemReference.log.append(f"Product {itemName} refers to product {x.itemNumber} for which there is no definition in the source data.")
+      if maxLevel < componentLevel:
+        maxLevel = componentLevel
 
-      # Update the global maxLevel so that the recursive crawl through the top level product remembers
-      # the deepest level.
-      if maxLevel < currentLevel:
-         maxLevel = currentLevel
+    levels[u] = maxLevel
 
-      # Decerement currentLevel as we unwind the recursion
-      currentLevel = currentLevel - 1
+  return levels
 
 
 ############################################################################################################
@@ -288,59 +449,65 @@ def calculateProductTreeDepth(itemName):
 ############################################################################################################
 def calculateProductRolledUpCosts(conciseOutput):
 
-  global totalComponentCost
-  global calculateProductRolledUpCostSentinel
-
-  calculateProductRolledUpCostSentinel=True
-
-  for x in itemsDictionary:
-
-   itemReference = itemsDictionary[x]  
-
-   # Flag to to control detail of output
-   conciseOutput = False
-
-   # To create rolled up cost for this product, set total component cost to 0 before starting
-   # to crawl the tree
-   totalComponentCost = 0.0
-   itemReference.qtyPerTopItem = 1.0 # For the top item in a tree, this must be 1.0
-
-   if conciseOutput == False:
-      print (f"Product: {x}")
-      calculateProductRolledUpCost(x,1,True)  # silent = true to suppress output as crawl the tree
+  # Rolled up cost of every product, from a single pass over the whole product tree - the product's 
+  # own unit cost is not included
+  totalComponentCosts = jitCompiled(calculateTotalComponentCosts, len(productTree.itemNumbers))(
+                          productTree.indptr, productTree.indices, productTree.qtyPer, productTree.unitCost,
+                          productTree.order, productTree.inCycle)
+  totalComponentCosts = totalComponentCosts.tolist()
+
+  # The report lines are collected in outputLines and written out in one go rather than with a print
+  # per line
+  outputLines = []
+
+  if conciseOutput == False:
+    # Verbose Output - Product Number, Tree of Components, Warnings and Rolled Up Cost - written per product
+    for (x, itemReference), totalComponentCost in zip(itemsDictionary.items(), totalComponentCosts):
+      outputLines.clear()
+      outputLines.append(f"Product: {x}")
+      outputLines.extend(describeProductComponents(x))
    
       for logItem in itemReference.log:
-        print ("     ",logItem)
+        outputLines.append(f"      {logItem}")
 
-      print (f"   TOTAL COMPONENT COST: {round(totalComponentCost,4)}")
-      print("")
+      outputLines.append(f"   TOTAL COMPONENT COST: {round(totalComponentCost,4)}")
+      outputLines.append("")
+      sys.stdout.write("\n".join(outputLines) + "\n")
 
-   else:
-      # Concise Output - Product Number, Rolled Up Cost and Warnings
-      calculateProductRolledUpCost(x,1,False)  # silent = false to output component data as crawl the tree
-      print (f"Product {x} Rolled Up Cost: {round(totalComponentCost,4)}")
+  else:
+    # Concise Output - Product Number, Rolled Up Cost and Warnings - written for all products at once
+    for (x, itemReference), totalComponentCost in zip(itemsDictionary.items(), totalComponentCosts):
+      outputLines.append(f"Product {x} Rolled Up Cost: {round(totalComponentCost,4)}")
       for logItem in itemReference.log:
-         print ("     ",logItem)
+         outputLines.append(f"      {logItem}")
+
+    if outputLines:
+      sys.stdout.write("\n".join(outputLines) + "\n")
 
-  calculateProductRolledUpCostSentinel=False
-      
 
 ############################################################################################################
-# calculateProductRolledUpCost
+# describeProductComponents
 #
-# Function to crawl through the component products referenced by product with id itemName and to output
-# a description of the component items.
+# Function to describe the tree of component products of product itemNumber for the verbose rolled up cost
+# report - returns a list of report lines.
 ############################################################################################################
-def calculateProductRolledUpCost(itemNumber, level, silent):
-
-  global calculateProductRolledUpCostSentinel
-
-  if calculateProductRolledUpCostSentinel == False:
-    raise Exception("calculateProductRolledUpCost called without calling initialising function calculateProductRolledUpCosts")
-  else:
-    # Whilst navigating the tree of components, add the BOM cost of any component product which is 
-    # categorised as ReplenishmentSystem = "Purchase" to the global componentCost
-    global totalComponentCost 
+def describeProductComponents(itemNumber):
+
+  # Products on the path from the top product down to the product being crawled by describeComponents,
+  # and the description lines for the tree
+  onStack = set()
+  outputLines = []
+
+  ##########################################################################################################
+  # describeComponents
+  #
+  # RECURSIVE Function to crawl through the component products referenced by product with id itemNumber and 
+  # append a description of the component items to outputLines.  The rolled up cost itself is calculated by
+  # calculateTotalComponentCosts, this crawl only reports the tree of components.
+  #
+  # A component already in onStack closes a cycle in the product tree and is not crawled again.
+  ##########################################################################################################
+  def describeComponents(itemNumber, level):
 
     itemReference = itemsDictionary[itemNumber]
     parentQtyPerTopItem = itemReference.qtyPerTopItem
@@ -348,9 +515,11 @@ def calculateProductRolledUpCost(itemNumber, level, silent):
     componentCost = 0.0
     itemReplenishmentSystem = "Unknown"
 
+    onStack.add(itemNumber)
+
     for x in itemReference.itemList: 
         # Iterate over all the ComponentItem objects in the itemList for itemNumber
-        if str(x.itemNumber) in itemsDictionary:
+        if x.itemNumber in itemsDictionary and x.itemNumber not in onStack:
           itemChild = itemsDictionary[x.itemNumber]
           itemReplenishmentSystem = itemChild.replenishmentSystem
 
@@ -358,26 +527,61 @@ def calculateProductRolledUpCost(itemNumber, level, silent):
           itemChild.qtyPerTopItem = parentQtyPerTopItem * x.qtyPer
         
           # Only add in the cost of items that are of replenishment type Purchase
-          if itemReplenishmentSystem == "Purchase":
-              componentCost = float(itemChild.BOMUnitCost) * itemChild.qtyPerTopItem
-              totalComponentCost = totalComponentCost + componentCost
+          if itemChild.isPurchase:
+              componentCost = itemChild.BOMUnitCost * itemChild.qtyPerTopItem
+
+          strIndent = "\t" * level
 
-          strIndent = ""
-          for a in range(1,level+1):
-            strIndent = strIndent+"\t"
+          outputLines.append(strIndent + \
+                f"{x.itemNumber}\tQtyPer:{round(x.qtyPer,2)}\tCompCost:{round(componentCost,2)}\tQtyPerTop:{round(itemChild.qtyPerTopItem,2)}")
+          outputLines.append(strIndent + f"Replen:{itemReplenishmentSystem}\tUnitCost:{itemChild.BOMUnitCost:.2f}")
 
-          if silent == False:
-              print(strIndent + \
-                    f"{x.itemNumber}\tQtyPer:{round(x.qtyPer,2)}\tCompCost:{round(componentCost,2)}\tQtyPerTop:{round(itemChild.qtyPerTopItem,2)}")
-              print(strIndent + f"Replen:{itemReplenishmentSystem}\tUnitCost:{itemChild.BOMUnitCost}")
+          describeComponents(x.itemNumber,level+1)
 
-          calculateProductRolledUpCost(str(x.itemNumber),level+1, silent)
+    onStack.remove(itemNumber)
+
+  itemsDictionary[itemNumber].qtyPerTopItem = 1.0 # For the top item in a tree, this must be 1.0
+  describeComponents(itemNumber,1)  # output component data as crawl the tree
+
+  return outputLines
+
+
+############################################################################################################
+# calculateTotalComponentCosts
+#
+# Function to calculate the rolled up cost of every product in a CSR product tree in a single pass - the
+# cost of the product's components alone, which is the rolled up cost reported for the product.
+#
+# Along the way the pass works out the rolled up cost of one unit of each product: its own unit cost 
+# (0.0 unless it is of replenishment type Purchase, see ProductTree.unitCost) plus the cost of its 
+# components, qtyPer x the rolled up unit cost of each component product.  Working back through the 
+# topological order means the unit cost of every component product is already known, so no product 
+# needs a crawl of its own.
+#
+# A product in a cycle has no rolled up cost - it is set to NaN, as is the cost of any product made from it.
+############################################################################################################
+def calculateTotalComponentCosts(indptr, indices, qtyPer, unitCost, order, inCycle):
+
+  unitCosts = np.zeros(indptr.size - 1, dtype=np.float64)
+  totalComponentCosts = np.zeros(indptr.size - 1, dtype=np.float64)
+
+  for i in range(order.size - 1, -1, -1):
+    u = order[i]
+
+    if inCycle[u]:
+      unitCosts[u] = np.nan
+      totalComponentCosts[u] = np.nan
+      continue
+
+    componentCost = 0.0
+    for k in range(indptr[u], indptr[u+1]):
+      if indices[k] >= 0:
+        componentCost = componentCost + qtyPer[k] * unitCosts[indices[k]]
 
-        else:
-          # Could not find item in the Dictionary   - a product referenced by a product
-          # was not defined in the input data
-          itemReference.log.append(f"Product {itemNumber} refers to product {x.itemNumber} for which there is no definition in the source data.")
+    unitCosts[u] = unitCost[u] + componentCost
+    totalComponentCosts[u] = componentCost
 
+  return totalComponentCosts
 
 
  
@@ -391,25 +595,24 @@ if __name__ == "__main__":
   # 1. Output any warnings after the input data is validated - eg Component Products for 
   # which there is no full Product definition.  This type of error may make the 
   # product level or rolled up costs incorrect.
-  resetProductWarnings()
+  # The warnings logged here are kept and reported again against each product in the rolled up cost
+  # report - the depth and cost calculations skip undefined component products without logging them again.
   validateProductTree()
   reportProductWarnings()
 
   # 2. Output the product level for each product
-  resetProductWarnings()
   calculateProductTreeDepths()
   #  Report the item level for each product
   print("")
   print("================================== ")
   print("=== Product Levels per Product === ")
   print("================================== ")
-  for x in itemsDictionary:
-      print ("Item "+ str(itemsDictionary[x].item_number) + " Level - " + str(itemsDictionary[x].level))
+  for itemReference in itemsDictionary.values():
+      print (f"Item {itemReference.item_number} Level - {itemReference.level}")
   ### reportProductWarnings()
 
 
   # 3. Output Verbose or Concise Report Of Rolled Up Cost Each Product
-  resetProductWarnings()
   # Report the rolled up costs per product
 
   conciseRolledUpCostReport = True